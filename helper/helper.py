@@ -1,20 +1,49 @@
 import argparse
 import sys
 from upstash_redis import Redis
-import requests
-import concurrent.futures
+import asyncio
+import httpx
+import json
+from importlib.util import find_spec
+import os
+import random
 import time
 from tqdm import tqdm
-from typing import Tuple, Literal, List, Set
+from typing import Iterator, Tuple, Literal, List, Set
 
 # --- Key Checker Configuration ---
 MAX_RETRIES = 3
-RETRY_DELAY_SECONDS = 2
-MAX_WORKERS = 200
+RETRY_BASE_DELAY_SECONDS = 0.5
+RETRY_MAX_DELAY_SECONDS = 8
+RETRY_JITTER_SECONDS = 0.25
+RETRYABLE_STATUS_CODES = {500, 502, 503, 504}
+MAX_WORKERS = 32
+SSCAN_COUNT = 500
+# Results are appended here as each check completes so an interrupted run can resume
+CHECKED_ACTIVE_FILE = 'txt/checked_active.txt'
+CHECKED_INVALID_FILE = 'txt/checked_invalid.txt'
+# HTTP/2 needs the optional h2 package (pip install 'httpx[http2]'); fall back to HTTP/1.1 without it
+HTTP2_AVAILABLE = find_spec('h2') is not None
 API_URL = "https://generativelanguage.googleapis.com/v1/models/gemini-1.5-flash:generateContent"
-
-
-# Initialize Redis client - this can be shared across all functions
+# The check payload never changes, so encode it once instead of on every request
+PAYLOAD_BYTES = json.dumps({'contents': [{'parts': [{'text': 'hello'}]}]}).encode('utf-8')
+PAYLOAD_HEADERS = {'Content-Type': 'application/json'}
+
+# Adds every (key, expiration) pair in ARGV to the set and hash server-side,
+# returning how many keys were new to the set
+ADD_AUTHS_SCRIPT = """
+local added = 0
+for i = 1, #ARGV, 2 do
+    added = added + redis.call('SADD', KEYS[1], ARGV[i])
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+end
+return added
+"""
+
+
+# Initialize Redis client - this can be shared across all functions.
+# upstash_redis keeps one persistent httpx client per Redis instance, so reusing
+# this one instance keeps the REST connections alive instead of handshaking per command.
 try:
     redis = Redis(url="redis url", token="redis token")
 except Exception as e:
@@ -37,9 +66,10 @@ def add_auths():
         set_name = "AUTH_SECRET_SET"
         hash_name = "AUTH_SECRET_EXPIRATION_HASH"
         
-        successful_additions = 0
         print(f"Found {len(keys)} keys to process in 'txt/add_auths.txt'.")
 
+        # Collect every expiration up front so all writes can go out in one batch
+        entries = []
         for key in keys:
             while True:
                 try:
@@ -53,13 +83,15 @@ def add_auths():
                     print("    [Error] Invalid input. Please enter an integer.")
             
             expiration_timestamp = int(time.time()) + (days * 24 * 60 * 60)
-
-            # Execute commands directly
-            sadd_result = redis.sadd(set_name, key)
-            redis.hset(hash_name, key, str(expiration_timestamp))
-
-            if sadd_result == 1:
-                 successful_additions += 1
+            entries.append((key, expiration_timestamp, days))
+
+        # Run sadd + hset for all keys in one atomic server-side script
+        args = []
+        for key, expiration_timestamp, _ in entries:
+            args.append(key)
+            args.append(str(expiration_timestamp))
+        successful_additions = redis.eval(ADD_AUTHS_SCRIPT, keys=[set_name, hash_name], args=args)
+        for key, _, days in entries:
             print(f"    + Key '{key}' added with a validity of {days} days.")
 
         print("\n--- Summary ---")
@@ -67,8 +99,7 @@ def add_auths():
         print(f"Successfully added {successful_additions} new keys.")
         
         # Clear the file after successful operation
-        with open('txt/add_auths.txt', 'w') as f:
-            pass
+        os.truncate('txt/add_auths.txt', 0)
         print("Cleared 'txt/add_auths.txt'.")
 
     except FileNotFoundError:
@@ -94,8 +125,7 @@ def delete_auths():
         print(f"Total keys processed for deletion: {len(keys_to_delete)}.")
 
         # Clear the file after successful operation
-        with open('txt/delete_auths.txt', 'w') as f:
-            pass
+        os.truncate('txt/delete_auths.txt', 0)
         print("Cleared 'txt/delete_auths.txt'.")
 
     except FileNotFoundError:
@@ -118,13 +148,21 @@ def check_expired_auths():
             return
 
         expired_keys = []
+        append_expired = expired_keys.append
         for key, timestamp in all_auths.items():
-            try:
-                if int(timestamp) < current_time:
-                    expired_keys.append(key)
-            except ValueError:
-                print(f"    [Warning] Invalid timestamp value found for key '{key}': '{timestamp}'. Marking for removal.")
-                expired_keys.append(key)
+            # Fast path: plain decimal strings (what add_auths writes) always parse, so skip the try.
+            # Anything else still goes through int(), which also accepts whitespace, signs and underscores.
+            if timestamp.isdecimal():
+                expiration = int(timestamp)
+            else:
+                try:
+                    expiration = int(timestamp)
+                except ValueError:
+                    print(f"    [Warning] Invalid timestamp value found for key '{key}': '{timestamp}'. Marking for removal.")
+                    append_expired(key)
+                    continue
+            if expiration < current_time:
+                append_expired(key)
 
         if not expired_keys:
             print("No expired auth keys found.")
@@ -132,9 +170,11 @@ def check_expired_auths():
 
         print(f"Found {len(expired_keys)} expired auth keys. Removing them...")
 
-        # Execute commands directly
-        removed_from_set = redis.srem(set_name, *expired_keys)
-        removed_from_hash = redis.hdel(hash_name, *expired_keys)
+        # Remove from set and hash in one MULTI/EXEC so both stay consistent
+        transaction = redis.multi()
+        transaction.srem(set_name, *expired_keys)
+        transaction.hdel(hash_name, *expired_keys)
+        removed_from_set, removed_from_hash = transaction.exec()
 
         print(f"Successfully removed {removed_from_set} keys from '{set_name}'.")
         print(f"Successfully removed {removed_from_hash} keys from '{hash_name}'.")
@@ -161,8 +201,7 @@ def add_keys():
         print(f"Total keys processed: {len(keys)}.")
 
         # Clear the file after successful operation
-        with open('txt/add_keys.txt', 'w') as f:
-            pass
+        os.truncate('txt/add_keys.txt', 0)
         print("Cleared 'txt/add_keys.txt'.")
 
     except FileNotFoundError:
@@ -188,8 +227,7 @@ def delete_keys():
         print(f"Total keys processed for deletion: {len(keys_to_delete)}.")
 
         # Clear the file after successful operation
-        with open('txt/delete_keys.txt', 'w') as f:
-            pass
+        os.truncate('txt/delete_keys.txt', 0)
         print("Cleared 'txt/delete_keys.txt'.")
 
     except FileNotFoundError:
@@ -203,21 +241,24 @@ def deduplicate_keys():
     Reads keys from txt/allkeys.txt, removes duplicates, and overwrites the file.
     """
     keys_file = 'txt/allkeys.txt'
+    tmp_file = keys_file + '.tmp'
     try:
-        with open(keys_file, 'r', encoding='utf-8') as f:
-            all_keys_list = [line.strip() for line in f if line.strip()]
-        
-        original_key_count = len(all_keys_list)
+        # Split the whole file in C in one call; dict.fromkeys dedups while keeping first-seen order
+        with open(keys_file, 'rb') as f:
+            all_keys = f.read().split()
+
+        original_key_count = len(all_keys)
         if original_key_count == 0:
             print("No keys found in txt/allkeys.txt.")
             return
-            
-        unique_keys = sorted(list(set(all_keys_list)))
+
+        unique_keys = list(dict.fromkeys(all_keys))
         unique_key_count = len(unique_keys)
 
-        with open(keys_file, 'w', encoding='utf-8') as f:
-            for key in unique_keys:
-                f.write(f"{key}\n")
+        with open(tmp_file, 'wb') as f:
+            f.write(b'\n'.join(unique_keys))
+            f.write(b'\n')
+        os.replace(tmp_file, keys_file)
 
         print("\n" + "="*35)
         print("         Key Deduplication Complete")
@@ -235,24 +276,162 @@ def deduplicate_keys():
         print(f"An error occurred during deduplication: {e}")
 
 
-def _check_key_validity(key: str) -> Tuple[Literal['active', 'invalid'], str]:
+def _atomic_write(path: str, keys: List[str]) -> None:
     """
-    Helper function to check a single API key's validity.
+    Writes keys one per line to a temp file and swaps it into place, so a
+    crash mid-write never leaves a truncated file behind.
     """
-    url_with_key = f"{API_URL}?key={key}"
-    payload = {'contents': [{'parts': [{'text': 'hello'}]}]}
-    
-    for _ in range(MAX_RETRIES):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        if keys:
+            f.write('\n'.join(keys))
+            f.write('\n')
+    os.replace(tmp_path, path)
+
+
+async def _check_key_validity(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, key: str) -> Tuple[Literal['active', 'invalid', 'unknown'], str]:
+    """
+    Helper coroutine to check a single API key's validity. Returns 'unknown'
+    when no decisive status was received (transport errors or retryable 5xx
+    on every attempt); a 5xx is not a verdict, so the key must be rechecked.
+    """
+    for attempt in range(MAX_RETRIES):
         try:
-            response = requests.post(url_with_key, json=payload, timeout=20)
+            # Over HTTP/2 the connection limit doesn't bound concurrent streams, so cap in-flight requests here
+            async with semaphore:
+                response = await client.post(API_URL, params={'key': key}, content=PAYLOAD_BYTES, headers=PAYLOAD_HEADERS)
             if response.status_code in [200, 429]:
                 return 'active', key
-            if response.status_code in [403,503]:
-                return 'invalid', key
-        except requests.exceptions.RequestException:
-            pass # Errors will lead to retry, and eventually 'invalid'
-        time.sleep(RETRY_DELAY_SECONDS)
-    return 'invalid', key
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                return 'invalid', key # 400/401/403 etc. are decisive, retrying won't help
+        except httpx.TransportError:
+            pass # Connection errors and timeouts will lead to retry, and eventually 'unknown'
+        except httpx.HTTPError:
+            return 'unknown', key
+        if attempt < MAX_RETRIES - 1:
+            # Exponential backoff with jitter so retries don't hit the endpoint in lockstep
+            delay = min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** attempt)
+            await asyncio.sleep(delay + random.random() * RETRY_JITTER_SECONDS)
+    return 'unknown', key
+
+
+def _iter_redis_set(set_name: str) -> Iterator[List[str]]:
+    """
+    Yields the members of a Redis set in bounded chunks using SSCAN.
+    """
+    cursor = 0
+    while True:
+        cursor, chunk = redis.sscan(set_name, cursor, count=SSCAN_COUNT)
+        yield chunk
+        if int(cursor) == 0:
+            break
+
+
+def _read_checked_keys(path: str) -> Set[str]:
+    """
+    Reads keys recorded by an earlier, interrupted check run.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return {line.strip() for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def _remove_progress_files() -> None:
+    """
+    Deletes the check progress files once a run has finished.
+    """
+    for progress_file in (CHECKED_ACTIVE_FILE, CHECKED_INVALID_FILE):
+        if os.path.exists(progress_file):
+            os.remove(progress_file)
+
+
+async def _check_keys_async(set_name: str, file_keys: Set[str]) -> Tuple[Set[str], List[str], List[str]]:
+    """
+    Checks all keys concurrently on one event loop, sharing a single
+    connection pool so TCP/TLS connections are reused across requests.
+    Redis keys are streamed with SSCAN, and checks for each chunk start
+    while the next chunk is still being fetched. Keys already recorded by an
+    interrupted run are taken from the progress files instead of rechecked.
+    """
+    redis_keys: Set[str] = set()
+    active_keys: List[str] = []
+    invalid_keys: List[str] = []
+
+    checked_active = _read_checked_keys(CHECKED_ACTIVE_FILE)
+    checked_invalid = _read_checked_keys(CHECKED_INVALID_FILE)
+    if checked_active or checked_invalid:
+        print(f"Resuming previous check: {len(checked_active) + len(checked_invalid)} keys already checked.")
+
+    # Keep every pooled connection alive between requests; httpx only keeps 20 idle by default
+    limits = httpx.Limits(max_connections=MAX_WORKERS, max_keepalive_connections=MAX_WORKERS)
+    # Fail fast on connect, allow 10s for a slow response, and no pool timeout:
+    # keys queued behind the connection limit must not fail
+    timeout = httpx.Timeout(10, connect=5, pool=None)
+    with open(CHECKED_ACTIVE_FILE, 'a', encoding='utf-8', buffering=1 << 16) as active_out, \
+            open(CHECKED_INVALID_FILE, 'a', encoding='utf-8', buffering=1 << 16) as invalid_out:
+
+        def record(task: asyncio.Task) -> None:
+            # Runs as soon as a check finishes, so results are saved even while SSCAN is still running
+            if task.cancelled() or task.exception() is not None:
+                return
+            status, key = task.result()
+            if status == 'active':
+                active_keys.append(key)
+                active_out.write(key + '\n')
+            elif status == 'invalid':
+                invalid_keys.append(key)
+                invalid_out.write(key + '\n')
+            else:
+                # No decisive status (transport errors or retryable 5xx on every attempt):
+                # count as invalid for this run, but don't save it so a resumed run checks the key again
+                invalid_keys.append(key)
+
+        # HTTP/2 multiplexes concurrent checks as streams over a handful of connections
+        async with httpx.AsyncClient(http2=HTTP2_AVAILABLE, limits=limits, timeout=timeout) as client:
+            semaphore = asyncio.Semaphore(MAX_WORKERS)
+            scheduled: Set[str] = set()
+            checks = []
+
+            def schedule(keys):
+                for key in keys:
+                    if key in scheduled:
+                        continue
+                    scheduled.add(key)
+                    if key in checked_active:
+                        active_keys.append(key)
+                    elif key in checked_invalid:
+                        invalid_keys.append(key)
+                    else:
+                        check = asyncio.create_task(_check_key_validity(client, semaphore, key))
+                        check.add_done_callback(record)
+                        checks.append(check)
+
+            schedule(file_keys)
+
+            # The Redis client is blocking, so fetch chunks off the event loop
+            chunks = _iter_redis_set(set_name)
+            while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+                redis_keys.update(chunk)
+                schedule(chunk)
+
+            print(f"Found {len(redis_keys)} keys in Redis set '{set_name}'.")
+            print("Redis keys:\n" + "\n".join(sorted(redis_keys)) + "\n")
+
+            if not checks:
+                return redis_keys, active_keys, invalid_keys
+
+            print(f"Found {len(scheduled)} unique keys in total, {len(checks)} left to check. Waiting for validity check...")
+
+            key_count = len(checks)
+            # Results are recorded by the done-callback; this loop only drives the progress bar.
+            # Throttle redraws to ~200 updates so large runs don't refresh the bar per key
+            for future in tqdm(asyncio.as_completed(checks), total=key_count, desc="Checking Keys",
+                               mininterval=0.5, miniters=max(1, key_count // 200)):
+                await future
+
+    return redis_keys, active_keys, invalid_keys
 
 
 def check_api_keys():
@@ -266,12 +445,7 @@ def check_api_keys():
     set_name = "GEMINI_API_KEY_SET"
     
     try:
-        # 1. Get keys from Redis
-        redis_keys: Set[str] = set(redis.smembers(set_name))
-        print(f"Found {len(redis_keys)} keys in Redis set '{set_name}'.")
-        print("Redis keys:\n" + "\n".join(sorted(redis_keys)) + "\n")
-
-        #2. Get keys from allkeys.txt
+        # 1. Get keys from allkeys.txt
         file_keys: Set[str] = set()
         try:
             with open(source_keys_file, 'r', encoding='utf-8') as f:
@@ -280,46 +454,32 @@ def check_api_keys():
         except FileNotFoundError:
             print(f"'{source_keys_file}' not found. Continuing with Redis keys only.")
 
-        # 3. Combine and deduplicate
-        all_keys = list(redis_keys.union(file_keys))
+        # 2. Stream keys from Redis and check the combined, deduplicated keys as they arrive
+        redis_keys, active_keys, invalid_keys = asyncio.run(_check_keys_async(set_name, file_keys))
 
-        if not all_keys:
+        key_count = len(active_keys) + len(invalid_keys)
+        if key_count == 0:
+            _remove_progress_files()
             print(f"No keys found in Redis or '{source_keys_file}' to check.")
             return
 
-        key_count = len(all_keys)
-        print(f"Found {key_count} unique keys in total. Starting validity check...")
-
-        active_keys: List[str] = []
-        invalid_keys: List[str] = []
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            future_to_key = {executor.submit(_check_key_validity, key): key for key in all_keys}
-            for future in tqdm(concurrent.futures.as_completed(future_to_key), total=key_count, desc="Checking Keys"):
-                status, key = future.result()
-                if status == 'active':
-                    active_keys.append(key)
-                else:
-                    invalid_keys.append(key)
-
         print("\nCheck complete. Optimizing and sorting keys for Redis update...")
 
         # Filter keys for efficient updates
-        keys_to_add = [key for key in active_keys if key not in redis_keys]
-        keys_to_remove = [key for key in invalid_keys if key in redis_keys]
+        keys_to_add = set(active_keys) - redis_keys
+        keys_to_remove = set(invalid_keys) & redis_keys
 
         # Write active keys that are NOT in Redis to add_keys.txt
-        with open(add_keys_file, 'w', encoding='utf-8') as f:
-            for key in sorted(keys_to_add):
-                f.write(f"{key}\n")
+        _atomic_write(add_keys_file, sorted(keys_to_add))
         print(f"'{add_keys_file}' has been updated with {len(keys_to_add)} new active keys to be added.")
 
         # Write invalid keys that ARE in Redis to delete_keys.txt
-        with open(delete_keys_file, 'w', encoding='utf-8') as f:
-            for key in sorted(keys_to_remove):
-                f.write(f"{key}\n")
+        _atomic_write(delete_keys_file, sorted(keys_to_remove))
         print(f"'{delete_keys_file}' has been updated with {len(keys_to_remove)} invalid keys to be removed.")
 
+        # Results are saved, so the next run should check every key again
+        _remove_progress_files()
+
         # Print final summary
         print("\n" + "="*35)
         print("         Key Check Summary")
@@ -333,11 +493,11 @@ def check_api_keys():
         print("="*35)
 
         # --- Backup active keys ---
-        final_keys = (redis_keys.union(set(keys_to_add))) - set(keys_to_remove)
+        # keys_to_add and keys_to_remove are disjoint, so build this with one copy of redis_keys
+        final_keys = redis_keys - keys_to_remove
+        final_keys |= keys_to_add
         try:
-            with open('txt/backend.txt', 'w', encoding='utf-8') as f:
-                for key in sorted(list(final_keys)):
-                    f.write(f"{key}\n")
+            _atomic_write('txt/backend.txt', sorted(final_keys))
             print(f"Successfully backed up {len(final_keys)} final valid keys to 'txt/backend.txt'.")
         except Exception as e:
             print(f"Error backing up keys to 'txt/backend.txt': {e}")